@@ -1,4 +1,15 @@
+import hashlib
+import io
+import logging
 import os
+
+# Default to a CPU-only deployment: hide CUDA devices and silence TF logging before TensorFlow
+# is imported. setdefault keeps any value the host already sets, e.g. to use a GPU.
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+
+import queue
+import threading
 import streamlit as st
 from dotenv import load_dotenv
 import google.generativeai as gen_ai
@@ -9,11 +20,31 @@ import wikipedia
 import pyttsx3
 import pydicom
 from lime import lime_image
-import matplotlib.pyplot as plt
+from lime.wrappers.scikit_image import SegmentationAlgorithm
+from skimage.segmentation import mark_boundaries
+
+logger = logging.getLogger(__name__)
+
+# Size TF thread pools for one user at a time; this must run before the first TF op.
+# Reruns setting the same values are accepted by TF, so a RuntimeError here means the
+# TF runtime was initialized first and the pools keep their defaults.
+NUM_THREADS = min(4, os.cpu_count() or 1)
+try:
+    tf.config.threading.set_intra_op_parallelism_threads(NUM_THREADS)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+except RuntimeError as e:
+    logger.warning(f"TF thread pools were configured too late and keep their defaults: {e}")
+
+# Keep XLA autoclustering off explicitly (TF2's CPU default); it gains nothing on this small model
+tf.config.optimizer.set_jit(False)
 
 # Load environment variables
 load_dotenv()
 
+# Maximum number of texts waiting to be read aloud, and seconds to wait for the TTS engine to start
+TTS_QUEUE_SIZE = 4
+TTS_INIT_TIMEOUT = 5
+
 # Configure Streamlit page settings
 st.set_page_config(
     page_title="Brain Tumor Detection & Help Assist.",
@@ -24,9 +55,11 @@ st.set_page_config(
 # API Key
 GOOGLE_API_KEY = os.getenv("ENTER YOUR API KEY")   # Ensure your environment variable is set correctly
 
-# Set up Google Gemini-Pro AI model
-gen_ai.configure(api_key=GOOGLE_API_KEY)
-model_gemini = gen_ai.GenerativeModel('gemini-pro')
+# Set up Google Gemini-Pro AI model lazily, on the first uncached chat reply, and share it across sessions
+@st.cache_resource(show_spinner=False)
+def load_gemini_model():
+    gen_ai.configure(api_key=GOOGLE_API_KEY)
+    return gen_ai.GenerativeModel('gemini-pro')
 
 # Define categories and symptoms
 categories = ["glioma", "meningioma", "no tumor", "pituitary"]
@@ -64,73 +97,184 @@ symptoms = {
     ]
 }
 
-# Load the trained model with caching
-@st.cache_data(show_spinner=False)
-def load_model(version="v1"):
-    model_path = 'brain_tumor_detection_model.h5'
-    return tf.keras.models.load_model(model_path)
+# Precompute a symptom mask per condition so diagnosis is a single matrix-vector product
+CONDITIONS = list(symptoms.keys())
+UNIQUE_SYMPTOMS = list(dict.fromkeys(symptom for symptom_list in symptoms.values() for symptom in symptom_list))
+COND_MASKS = np.stack([
+    np.array([symptom in symptoms[condition] for symptom in UNIQUE_SYMPTOMS], dtype=np.uint8)
+    for condition in CONDITIONS
+])
+COND_LENS = COND_MASKS.sum(axis=1)
+
+# Number of LIME perturbations and batch size for model calls
+# The batch size matches LIME's stack so it runs as one model call with no padding
+LIME_NUM_SAMPLES = 250
+BATCH_SIZE = LIME_NUM_SAMPLES
+
+# Paths of the converted TFLite model (see convert_model.py) and the original Keras model
+TFLITE_MODEL_PATH = 'brain_tumor_detection_model_fp16.tflite'
+KERAS_MODEL_PATH = 'brain_tumor_detection_model.h5'
+
+# Build a TFLite interpreter with its input fixed at (batch_size, 150, 150, 3), wrapped as run(batch_f32)
+# The interpreter is not thread-safe, so every run holds a lock around set_tensor/invoke/get_tensor
+# Partial chunks are copied into a padding buffer allocated once with the interpreter
+def load_interpreter(tflite_path, batch_size):
+    interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=NUM_THREADS)
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+    interpreter.resize_tensor_input(input_index, (batch_size, 150, 150, 3))
+    interpreter.allocate_tensors()
+    lock = threading.Lock()
+    padded = np.zeros((batch_size, 150, 150, 3), dtype=np.float32)
+
+    def run(batch_f32):
+        n = len(batch_f32)
+        with lock:
+            if n != batch_size:
+                padded[:n] = batch_f32
+                batch_f32 = padded
+            interpreter.set_tensor(input_index, batch_f32)
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index)[:n]
 
+    return run
+
+# Load the Keras model with its forward pass traced as a tf.function, wrapped as run(batch_f32)
+@st.cache_resource(show_spinner=False)
+def load_keras_model(version="v1"):
+    keras_model = tf.keras.models.load_model(KERAS_MODEL_PATH)
+
+    @tf.function(input_signature=[tf.TensorSpec([None, 150, 150, 3], tf.float32)])
+    def infer(x):
+        return keras_model(x, training=False)
+
+    def run(batch_f32):
+        return infer(tf.convert_to_tensor(batch_f32)).numpy()
+
+    return run
+
+# Load the model for a given batch size with caching, as a run(batch_f32) -> (N, 4) callable
+# Uses the TFLite model, falling back to the Keras model if it has not been converted yet
+# Neither can be pickled, so the model is cached as a shared resource
+@st.cache_resource(show_spinner=False)
+def load_model(batch_size=1, version="v1"):
+    if os.path.exists(TFLITE_MODEL_PATH):
+        return load_interpreter(TFLITE_MODEL_PATH, batch_size)
+    return load_keras_model(version)
+
+# Single-image model, loaded up front; the BATCH_SIZE model for LIME is only loaded on the
+# first explanation, since its tensor arena is large and most sessions never ask for one
 model = load_model()
 
-# Function to preprocess the image
-def preprocess_image(image):
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    img = image.resize((150, 150))
-    img_array = np.array(img) / 255.0
-    img_array = np.expand_dims(img_array, axis=0)
-    return img_array
+# Pixel scale factor, kept as float32 so scaling never promotes to float64
+_SCALE = np.float32(1 / 255.0)
+
+# Predict a preprocessed (N, 150, 150, 3) float32 batch with run, returning (N, 4) class scores
+# The model is run in BATCH_SIZE chunks that are written into one pre-allocated output buffer
+def _predict_batch(batch_f32, run):
+    outputs = np.empty((len(batch_f32), len(categories)), dtype=np.float32)
+    for start in range(0, len(batch_f32), BATCH_SIZE):
+        outputs[start:start + BATCH_SIZE] = run(batch_f32[start:start + BATCH_SIZE])
+    return outputs
+
+# Classifier for LIME: scale the whole (N, 150, 150, 3) uint8 perturbation stack once
+# Only called from cached_explain, which is what first loads the BATCH_SIZE model
+def classifier_fn(images):
+    batch_f32 = np.empty(images.shape, dtype=np.float32)
+    np.multiply(images, _SCALE, out=batch_f32)
+    return _predict_batch(batch_f32, load_model(BATCH_SIZE))
+
+# Function to resize the image once into the (150, 150, 3) uint8 array shared by predict and LIME
+def resize_image(image):
+    img = image.convert('RGB').resize((150, 150), Image.Resampling.BILINEAR)
+    return np.asarray(img, dtype=np.uint8)
+
+# Function to preprocess the resized image into a (1, 150, 150, 3) float32 batch
+def preprocess_image(img_array):
+    out = np.empty((1, 150, 150, 3), dtype=np.float32)
+    np.multiply(img_array, _SCALE, out=out[0])
+    return out
 
 # Enhanced validation function using pydicom
+# DICOM files carry the b'DICM' magic at byte 128, so only those are parsed with pydicom
 def is_valid_mri(file):
+    file.seek(128)
+    magic = file.read(4)
+    file.seek(0)
     try:
-        dicom_file = pydicom.dcmread(file, force=True)
-        if dicom_file.Modality == 'MR':
-            return True
+        if magic == b'DICM':
+            dicom_file = pydicom.dcmread(file)
+            return dicom_file.Modality == 'MR'
+        Image.open(file).verify()
+        return True
     except Exception as e:
-        try:
-            image = Image.open(file)
-            return True
-        except Exception as e:
-            st.warning(f"Image validation failed: {e}")
+        st.warning(f"Image validation failed: {e}")
+    finally:
+        file.seek(0)
     return False
 
-# Function to predict the tumor type and confidence score
-def predict(image):
-    preprocessed_image = preprocess_image(image)
+# Decode the uploaded image bytes into the resized (150, 150, 3) uint8 array
+# Cached on the blake2b digest so predict and LIME share one decode and resize per image
+@st.cache_data(show_spinner=False, max_entries=32)
+def decode_image(image_digest, _image_bytes):
+    return resize_image(Image.open(io.BytesIO(_image_bytes)))
+
+# Class scores for an uploaded image, cached on the blake2b digest of its bytes
+@st.cache_data(show_spinner=False, max_entries=32)
+def cached_predict(image_digest, _image_bytes):
+    return _predict_batch(preprocess_image(decode_image(image_digest, _image_bytes)), model)[0]
+
+# Function to predict the tumor type, its confidence score and the scores of all categories
+def predict(image_digest, image_bytes):
     try:
-        predictions = model.predict(preprocessed_image)
-        confidence = np.max(predictions)
-        tumor_type = categories[np.argmax(predictions)]
-        return tumor_type, confidence
+        probs = cached_predict(image_digest, image_bytes)
+        idx = int(probs.argmax())
+        return categories[idx], float(probs[idx]), probs
     except Exception as e:
         st.error(f"Error in prediction: {e}")
-        return None, None
+        return None, None, None
+
+# Create the LIME explainer and quickshift segmenter once and share them across reruns
+@st.cache_resource(show_spinner=False)
+def load_explainer():
+    explainer = lime_image.LimeImageExplainer()
+    segmenter = SegmentationAlgorithm('quickshift', kernel_size=3, max_dist=6, ratio=0.2)
+    return explainer, segmenter
+
+_EXPLAINER, _SEGMENTER = load_explainer()
+
+# LIME overlay for an uploaded image as a uint8 array, cached on the blake2b digest of its bytes
+@st.cache_data(show_spinner=False, max_entries=32)
+def cached_explain(image_digest, _image_bytes):
+    explanation = _EXPLAINER.explain_instance(
+        decode_image(image_digest, _image_bytes),
+        classifier_fn,
+        top_labels=1,
+        hide_color=0,
+        segmentation_fn=_SEGMENTER,
+        num_samples=LIME_NUM_SAMPLES,
+        batch_size=BATCH_SIZE
+    )
+    temp, mask = explanation.get_image_and_mask(
+        explanation.top_labels[0],
+        positive_only=True,
+        num_features=5,
+        hide_rest=False
+    )
+    overlay = mark_boundaries(temp / 255.0, mask)
+    return (overlay * 255).astype(np.uint8)
 
 # Function to add model explainability using LIME
-def explain_prediction(image, model):
+def explain_prediction(image_digest, image_bytes):
     try:
-        explainer = lime_image.LimeImageExplainer()
-        explanation = explainer.explain_instance(
-            np.array(image.resize((150, 150))),
-            model.predict,
-            top_labels=1,
-            hide_color=0,
-            num_samples=1000
-        )
+        overlay = cached_explain(image_digest, image_bytes)
         st.subheader("OUTPUT of the SCAN :")
-        temp, mask = explanation.get_image_and_mask(
-            explanation.top_labels[0],
-            positive_only=True,
-            num_features=5,
-            hide_rest=False
-        )
-        plt.imshow(temp)
-        st.pyplot(plt)
+        st.image(overlay, channels="RGB", width=300)
     except Exception as e:
         st.error(f"Error in explanation: {e}")
 
-# Function to get tumor information from Wikipedia
+# Function to get tumor information from Wikipedia, cached for a day per tumor type
+@st.cache_data(ttl=86400, show_spinner=False)
 def get_tumor_info(tumor_type):
     try:
         summary = wikipedia.summary(tumor_type, sentences=2)
@@ -140,24 +284,65 @@ def get_tumor_info(tumor_type):
     except wikipedia.exceptions.PageError:
         return f"No information found on Wikipedia for {tumor_type}."
 
+# Get a Gemini reply for a query given the conversation so far, cached on (history, query)
+# history is a tuple of (role, text) turns, with roles in Gemini terms ("user" / "model")
+@st.cache_data(ttl=86400, max_entries=128, show_spinner=False)
+def get_cached_gemini_reply(history, query):
+    chat_session = load_gemini_model().start_chat(
+        history=[{"role": role, "parts": [text]} for role, text in history]
+    )
+    # Assuming that send_message() returns a response object with a 'text' attribute
+    return chat_session.send_message(query).text
+
 # Function to get a response from Google Gemini
+# The conversation is kept in st.session_state.chat_history as a list of (role, text) turns
 def get_chatbot_response(query):
     try:
-        # Assuming that send_message() returns a response object with a 'text' attribute
-        gemini_response = st.session_state.chat_session.send_message(query)
-        return gemini_response.text
+        history = st.session_state.setdefault("chat_history", [])
+        gemini_response = get_cached_gemini_reply(tuple(history), query)
+        history.extend([("user", query), ("model", gemini_response)])
+        return gemini_response
     except Exception as e:
         st.error(f"Error with Google Gemini API: {e}")
         return "Sorry, I couldn't fetch the response."
 
-# Initialize TTS engine
-engine = pyttsx3.init()
+# Start the TTS worker once; the engine lives on its own thread so playback never blocks the UI
+# The worker reports whether the engine started, so a broken engine surfaces in speak_text
+@st.cache_resource(show_spinner=False)
+def start_tts_worker():
+    tts_queue = queue.Queue(maxsize=TTS_QUEUE_SIZE)
+    init_result = queue.Queue(maxsize=1)
+
+    def worker():
+        try:
+            engine = pyttsx3.init()
+        except Exception as e:
+            init_result.put(e)
+            return
+        init_result.put(None)
+        while True:
+            text = tts_queue.get()
+            try:
+                engine.say(text)
+                engine.runAndWait()
+            except Exception:
+                logger.exception("TTS playback failed")
+
+    threading.Thread(target=worker, daemon=True).start()
+    try:
+        init_error = init_result.get(timeout=TTS_INIT_TIMEOUT)
+    except queue.Empty:
+        raise RuntimeError(f"TTS engine did not start within {TTS_INIT_TIMEOUT} seconds")
+    if init_error is not None:
+        raise init_error
+    return tts_queue
 
 # Function to speak out the response
 def speak_text(text):
     try:
-        engine.say(text)
-        engine.runAndWait()
+        start_tts_worker().put_nowait(text)
+    except queue.Full:
+        st.error("Error with TTS: still reading earlier text, please try again shortly.")
     except Exception as e:
         st.error(f"Error with TTS: {e}")
 
@@ -178,31 +363,24 @@ if app_mode == "Diagnosis Test":
     st.header("Diagnosis Test")
     st.write("Please select the symptoms you are experiencing.")
 
-    symptom_selection = {}
-    for symptom_list in symptoms.values():
-        for symptom in symptom_list:
-            if symptom not in symptom_selection:
-                symptom_selection[symptom] = st.checkbox(symptom, key=symptom)
-    
+    symptom_selection = {symptom: st.checkbox(symptom, key=symptom) for symptom in UNIQUE_SYMPTOMS}
+
     if st.button("Diagnose"):
         selected_symptoms = [symptom for symptom, selected in symptom_selection.items() if selected]
         if not selected_symptoms:
             st.warning("Please select at least one symptom.")
         else:
             st.write(f"Selected Symptoms: {', '.join(selected_symptoms)}")
-            probabilities = {condition: 0 for condition in symptoms.keys()}
+            selected = np.array([symptom_selection[symptom] for symptom in UNIQUE_SYMPTOMS], dtype=np.uint8)
+            match_counts = COND_MASKS @ selected
+            probabilities = match_counts / COND_LENS * 100.0
 
-            for condition, symptom_list in symptoms.items():
-                match_count = sum(1 for symptom in selected_symptoms if symptom in symptom_list)
-                probability = (match_count / len(symptom_list)) * 100
-                probabilities[condition] = probability
-
-            max_prob = max(probabilities.values())
+            max_prob = probabilities.max()
             st.write("Diagnosis Result:")
-            for condition, probability in probabilities.items():
+            for condition, probability in zip(CONDITIONS, probabilities):
                 st.write(f"{condition}: {probability:.2f}%")
 
-            if list(probabilities.values()).count(max_prob) > 1:
+            if np.count_nonzero(probabilities == max_prob) > 1:
                 st.warning("There may be a clash between multiple conditions. Please consult a doctor.")
             elif max_prob == 0:
                 st.warning("No matching conditions found. Please consult a doctor for further evaluation.")
@@ -212,37 +390,45 @@ elif app_mode == "Tumor Detection":
     uploaded_file = st.file_uploader("Upload an MRI image", type=["dcm", "jpg", "png", "jpeg"])
 
     if uploaded_file is not None:
-        if is_valid_mri(uploaded_file):
-            image = Image.open(uploaded_file)
-            st.image(image, caption="Uploaded Image", use_column_width=True)
+        # Read the upload once; the bytes are shared by validation, display and the cached model helpers
+        image_bytes = uploaded_file.getvalue()
+        image_digest = hashlib.blake2b(image_bytes).hexdigest()
+        image_buffer = io.BytesIO(image_bytes)
+        if is_valid_mri(image_buffer):
+            st.image(image_bytes, caption="Uploaded Image", use_column_width=True)
 
+            # Remember which image was predicted so the result survives the reruns
+            # triggered by the explanation and read-aloud buttons
             if st.button("Predict"):
+                st.session_state.predicted_digest = image_digest
+
+            if st.session_state.get("predicted_digest") == image_digest:
                 with st.spinner('Predicting...'):
-                    prediction, confidence = predict(image)
+                    prediction, confidence, probs = predict(image_digest, image_bytes)
                 if prediction:
                     st.write(f"Prediction: {prediction}")
-                    explain_prediction(image, model)
+                    for category, prob in zip(categories, probs):
+                        st.write(f"{category}: {prob * 100:.2f}%")
                     tumor_info = get_tumor_info(prediction)
                     st.write(f"Tumor Information: {tumor_info}")
-                    speak_text(tumor_info)
+                    # Same for the explanation: keep the overlay once requested for this image
+                    if st.button("Show LIME explanation"):
+                        st.session_state.explained_digest = image_digest
+                    if st.session_state.get("explained_digest") == image_digest:
+                        with st.spinner('Explaining...'):
+                            explain_prediction(image_digest, image_bytes)
+                    if st.button("Read aloud"):
+                        speak_text(tumor_info)
         else:
             st.error("Invalid MRI image. Please upload a valid MRI image.")
 
 elif app_mode == "HELP ASSIST":
     st.header("Chat with the Assist")
-    
-    # Initialize chat session if not already present
-    if "chat_session" not in st.session_state:
-        try:
-            st.session_state.chat_session = model_gemini.start_chat(history=[])
-        except Exception as e:
-            st.error(f"Error initializing chat session: {e}")
 
     # Display the chat history
-    if "chat_session" in st.session_state:
-        for message in st.session_state.chat_session.history:
-            with st.chat_message(translate_role_for_streamlit(message.role)):
-                st.markdown(message.parts[0].text)
+    for role, text in st.session_state.get("chat_history", []):
+        with st.chat_message(translate_role_for_streamlit(role)):
+            st.markdown(text)
 
     # Input field for user's message
     user_prompt = st.chat_input("ASK FOR PRECAUTONS :")
@@ -0,0 +1,20 @@
+import tensorflow as tf
+
+# Paths of the trained Keras model and the converted TFLite model used by app.py
+KERAS_MODEL_PATH = 'brain_tumor_detection_model.h5'
+TFLITE_MODEL_PATH = 'brain_tumor_detection_model_fp16.tflite'
+
+# Convert the Keras model to TFLite with FP16 weights.
+# INT8 quantization is avoided on purpose: it is often slower than FP32 on x86 CPUs.
+def convert_model(keras_path=KERAS_MODEL_PATH, tflite_path=TFLITE_MODEL_PATH):
+    model = tf.keras.models.load_model(keras_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+    tflite_model = converter.convert()
+    with open(tflite_path, 'wb') as f:
+        f.write(tflite_model)
+    return tflite_path
+
+if __name__ == "__main__":
+    print(f"Saved TFLite model to {convert_model()}")